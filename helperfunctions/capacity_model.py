@@ -3,9 +3,9 @@
 import gurobipy as gp
 import pandas as pd
 import numpy as np
-import datetime
 import warnings
 import pytz
+from helperfunctions.gurobi_environment import gurobi_env
 
 def capacity_tariffs(charging_session_data, timesteplist, CS, DA_prices, dynamic_retail_prices_considered, capacity_tariff, initial_peak):
     """
@@ -23,152 +23,159 @@ def capacity_tariffs(charging_session_data, timesteplist, CS, DA_prices, dynamic
         pd.DataFrame: DataFrame indexed by timestep, containing optimized total charging power (column CS).
     """
 
-    # Initialize results DataFrame
-    resultdf = pd.DataFrame()
+    # Preallocate the total charging power at each timestep (0 at timesteps without active sessions)
+    p_tot_result = np.zeros(len(timesteplist))
 
     # Large number to scale the priority term
     M = 1e9
 
+    # 15-minute time resolution (in hours)
+    delta_t = 0.25
+
+    # Create one Gurobi model that is reused for all timesteps. Instead of rebuilding the model
+    # at every timestep, sessions are activated once they arrive and charging decisions that
+    # have already been made are fixed, so that each re-optimization starts from the previous basis.
+    m = gp.Model(env=gurobi_env)
+    m.Params.Method = 1  # Dual simplex, which re-optimizes efficiently after the bound changes between timesteps
+    m.Params.LPWarmStart = 2  # Use the previous basis as warm start, also through presolve
+    m.Params.Presolve = 1  # Conservative presolve, to keep the warm start close to the original model
+    m.Params.Threads = 1  # Multiple threads do not pay off for these small LPs
+
+    # Initialize variables
+    p_ch_session = {}        # Charging power per session
+    demand_constr = {}       # Energy demand constraint per session
+    C_DA_tot = gp.LinExpr()  # Total energy cost
+    p_tot = {}               # Total power per timestep
+    C_priority_tot = gp.LinExpr()  # Total priority cost
+    p_peak = m.addVar(lb=initial_peak)  # Peak capacity, at least the peak contracted or reached so far
+
+    # Convert timesteplist into DatetimeIndex for quick filtering
+    timesteps_index = pd.DatetimeIndex(timesteplist)
+
+    # Session characteristics as NumPy arrays, indexed by the position of the session
+    n_sessions = len(charging_session_data)
+    arrival = charging_session_data['Arrival time'].to_numpy(dtype='datetime64[ns]')
+    departure = charging_session_data['Departure time'].to_numpy(dtype='datetime64[ns]')
+    p_max_session = charging_session_data['Max. charging power (kW)'].to_numpy()
+    vol_session = charging_session_data['Charging demand (kWh)'].to_numpy()
+
+    # Timesteps as NumPy array to compare with the session arrival and departure times
+    timesteps_ns = timesteps_index.to_numpy(dtype='datetime64[ns]')
+
+    # Position of the first timestep within and the first timestep after each session window
+    # The timesteps of a session are the slice first_t:last_t of timesteplist
+    first_t = np.searchsorted(timesteps_ns, arrival, side='left')
+    last_t = np.searchsorted(timesteps_ns, departure, side='left')
+
+    # Day-ahead price (€/kWh) of the hour each timestep falls in
+    if dynamic_retail_prices_considered:
+        DA_price_at_t = DA_prices['Day-ahead price (€/MWh)'].reindex(
+            timesteps_index - pd.to_timedelta(timesteps_index.minute, unit='min')
+        ).to_numpy() / 1000
+
+    # Sweep with two pointers over the sessions sorted by arrival and by departure time to find the
+    # sessions that are active (arrival <= t < departure) at each timestep. Sessions without duration are skipped.
+    sessions_with_duration = np.flatnonzero(departure > arrival)
+    arr_order = sessions_with_duration[np.argsort(arrival[sessions_with_duration], kind='stable')]
+    dep_order = sessions_with_duration[np.argsort(departure[sessions_with_duration], kind='stable')]
+    active = set()
+    active_sessions_at = []
+    ai = 0
+    di = 0
+    for t_ns in timesteps_ns:
+        while ai < len(arr_order) and arrival[arr_order[ai]] <= t_ns:
+            active.add(arr_order[ai])
+            ai += 1
+        while di < len(dep_order) and departure[dep_order[di]] <= t_ns:
+            active.discard(dep_order[di])
+            di += 1
+        active_sessions_at.append(np.array(sorted(active), dtype=int))
+
+    # Define variables and constraints for each session. Sessions are added without any charging
+    # power or demand, so that the model does not anticipate sessions that did not arrive yet.
+    for session in range(n_sessions):
+        # Filter timesteps for this session
+        session_window = slice(first_t[session], last_t[session])
+        timesteplist_session = timesteps_index[session_window]
+
+        # Define charging power variables (upper bound is set to the session max power upon arrival)
+        p_ch_session[session] = m.addVars(timesteplist_session, lb=0, ub=0)
+        session_vars = list(p_ch_session[session].values())
+
+        # Ensure the correct amount of energy is delivered (right-hand side is set upon arrival)
+        demand_constr[session] = m.addConstr(
+            gp.LinExpr([delta_t] * len(session_vars), session_vars) == 0
+        )
+
+        # If dynamic pricing is active, add the energy cost of this session
+        if dynamic_retail_prices_considered:
+            C_DA_tot.addTerms((DA_price_at_t[session_window] * delta_t).tolist(), session_vars)
+
+        # Priority term to encourage early charging
+        C_priority_tot.addTerms(list(range(len(session_vars))), session_vars)
+
+    # Define total power at each timestep
+    for t_pos, t in enumerate(timesteplist):
+        # Find sessions connected at time t
+        charging_sessions_active_at_t = active_sessions_at[t_pos]
+
+        # Total charging power variable
+        p_tot[t] = m.addVar(lb=0)
+
+        # Total power = sum of active session powers
+        vars_at_t = [p_ch_session[session][t] for session in charging_sessions_active_at_t]
+        m.addConstr(p_tot[t] == gp.LinExpr([1.0] * len(vars_at_t), vars_at_t))
+
+        # Total power must not exceed the peak capacity
+        m.addConstr(p_tot[t] <= p_peak)
+
+    # Define the objective, with the cost terms as expressions instead of auxiliary variables.
+    # Only the peak capacity on top of the initial peak is paid for, but as initial_peak is the
+    # lower bound of p_peak this only shifts the objective by a constant.
+    C_grid = p_peak * capacity_tariff  # Grid (capacity) cost
+    if dynamic_retail_prices_considered:
+        # Objective: minimize energy + (grid/12 months) + priority term
+        obj = C_DA_tot + C_grid / 12 + C_priority_tot / M
+    else:
+        # If no DA prices, grid cost dominates
+        obj = C_grid / 12 + C_priority_tot / M
+    m.setObjective(obj, gp.GRB.MINIMIZE)
+
     # Loop over each timestep
-    for counter, timestep in enumerate(timesteplist):
-        
+    for timestep_pos, timestep in enumerate(timesteplist):
+
         # Find active charging sessions at current timestep
-        charging_session_data_timestep = charging_session_data[
-            (charging_session_data['Arrival time'] <= timestep) &
-            (charging_session_data['Departure time'] > timestep)
-        ]
+        active_sessions = active_sessions_at[timestep_pos]
 
         # Only optimize if there are active sessions
-        if len(charging_session_data_timestep) > 0:
-
-            # Create list of future timesteps since the considered timestep until the latest departure
-            timesteplist_remaining = [
-                t for t in timesteplist if t >= timestep and t < charging_session_data_timestep['Departure time'].max()
-            ]
-
-            # 15-minute time resolution (in hours)
-            delta_t = 0.25
-
-            # Create new Gurobi model
-            m = gp.Model()
-            m.Params.outputFlag = 0  # Suppress Gurobi output
-            m.Params.LogToConsole = 0
-
-            # Initialize variables
-            p_ch_session = {}       # Charging power per session
-            C_DA_session = {}        # Energy cost per session
-            C_DA_tot = m.addVar(lb=-np.inf)  # Total energy cost
-            p_tot = {}               # Total power per timestep
-            C_priority_session = {}  # Priority cost per session
-            C_priority_tot = m.addVar(lb=-np.inf)  # Total priority cost
-            C_grid = m.addVar(lb=-np.inf)   # Grid (capacity) cost
-            p_peak_extra = m.addVar(lb=0)   # Extra peak needed beyond initial contracted peak
-
-            # Convert timesteplist into DatetimeIndex for quick filtering
-            timesteps_index = pd.DatetimeIndex(timesteplist)
-
-            # Define variables and constraints for each active session
-            for session in list(charging_session_data_timestep.index):
-                # Session characteristics
-                arrival_time = charging_session_data_timestep.loc[session, 'Arrival time']
-                departure_time = charging_session_data_timestep.loc[session, 'Departure time']
-                p_max = charging_session_data_timestep.loc[session, 'Max. charging power (kW)']
-                vol = charging_session_data_timestep.loc[session, 'Charging demand (kWh)']
-
-                # Determine already charged volume (if the session started before the current timestep)
-                if session in resultdf.columns:\
-                    previously_charged_volume = resultdf[session].sum() * delta_t
-                else:
-                    previously_charged_volume = 0
-                    
-                # Filter future timesteps for this session
-                timesteplist_session = timesteps_index[
-                    (timesteps_index >= arrival_time) & (timesteps_index < departure_time)
-                ]
-
-                # Define charging power variables (bounded by session max power)
-                p_ch_session[session] = m.addVars(timesteplist_session, lb=0, ub=p_max)
-
-                # Ensure the correct amount of energy is delivered
-                m.addConstr(
-                    gp.quicksum(p_ch_session[session][t] * delta_t for t in timesteplist_session) ==
-                    (vol - previously_charged_volume)
-                )
-
-                # If dynamic pricing is active, define energy cost variable
-                if dynamic_retail_prices_considered:
-                    C_DA_session[session] = m.addVar(lb=-np.inf)
-                    m.addConstr(
-                        C_DA_session[session] == gp.quicksum(
-                            p_ch_session[session][t] * delta_t *
-                            DA_prices.loc[t - datetime.timedelta(minutes=t.minute), 'Day-ahead price (€/MWh)'] / 1000
-                            for t in timesteplist_session
-                        )
-                    )
-
-                # Priority term to encourage early charging
-                C_priority_session[session] = m.addVar(lb=0)
-                m.addConstr(
-                    C_priority_session[session] == gp.quicksum(
-                        p_ch_session[session][timesteplist_session[i]] * i for i in range(len(timesteplist_session))
-                    )
-                )
-            m.addConstr(C_priority_tot == gp.quicksum(C_priority_session[session] for session in charging_session_data_timestep.index))
-
-            # Define total power at each future timestep
-            for t in timesteplist_remaining:
-                # Find active sessions at time t
-                charging_sessions_active_at_t = charging_session_data[
-                    (charging_session_data_timestep['Arrival time'] <= t) &
-                    (charging_session_data['Departure time'] > t)
-                ]
-
-                # Total charging power variable
-                p_tot[t] = m.addVar(lb=0)
-
-                # Total power = sum of active session powers
-                m.addConstr(p_tot[t] == gp.quicksum(
-                    p_ch_session[session][t] for session in list(charging_sessions_active_at_t.index)
-                ))
-
-                # Total power must not exceed initial peak + extra peak bought
-                m.addConstr(p_tot[t] <= initial_peak + p_peak_extra)
-
-            # Define objective and constraints
-            if dynamic_retail_prices_considered:
-                # Total day-ahead cost
-                m.addConstr(C_DA_tot == gp.quicksum(C_DA_session[session] for session in list(charging_sessions_active_at_t.index)))
-
-                # Grid cost is the extra peak capacity multiplied by tariff
-                m.addConstr(C_grid == p_peak_extra * capacity_tariff)
-
-                # Objective: minimize energy + (grid/12 months) + priority term
-                obj = C_DA_tot + C_grid / 12 + C_priority_tot / M
-            else:
-                # If no DA prices, grid cost dominates
-                m.addConstr(C_grid == p_peak_extra * capacity_tariff)
-                obj = C_grid / 12 + C_priority_tot / M
-
-            # Set and optimize the objective
-            m.setObjective(obj, gp.GRB.MINIMIZE)
-            m.update()
+        if len(active_sessions) > 0:
+
+            # Activate sessions that arrive at this timestep
+            for session in active_sessions[first_t[active_sessions] == timestep_pos]:
+                session_vars = list(p_ch_session[session].values())
+                m.setAttr('UB', session_vars, [p_max_session[session]] * len(session_vars))
+                demand_constr[session].RHS = vol_session[session]
+
+            # Optimize the remaining charging schedule
             m.optimize()
 
-            # Save optimized total power for the current timestep
-            resultdf.at[timestep, CS] = p_tot[timestep].X
+            # Retrieve the total power, the charging power of the active sessions and the peak
+            # capacity in one call, before modifying the model
+            charged_vars = [p_ch_session[session][timestep] for session in active_sessions]
+            p_tot_value, peak, *charged_power = m.getAttr('X', [p_tot[timestep], p_peak] + charged_vars)
 
-            # Save session-level charging power decisions
-            for session in list(charging_session_data_timestep.index):
-                resultdf.at[timestep, session] = p_ch_session[session][timestep].X
+            # Save optimized total power for the current timestep
+            p_tot_result[timestep_pos] = p_tot_value
 
-            # Update initial_peak after buying any extra peak capacity
-            initial_peak += p_peak_extra.X
+            # Fix the charging power of the active sessions at this timestep, as this decision
+            # can no longer be revised in the optimizations of the following timesteps
+            m.setAttr('LB', charged_vars, charged_power)
+            m.setAttr('UB', charged_vars, charged_power)
 
-        else:
-            # No active sessions at this timestep
-            resultdf.at[timestep, CS] = 0
+            # Update the peak capacity that is available without additional costs
+            p_peak.LB = peak
 
     # Only return the total system power (CS column)
-    resultdf = pd.DataFrame(resultdf[CS])
+    resultdf = pd.DataFrame({CS: p_tot_result}, index=timesteplist)
 
     return resultdf
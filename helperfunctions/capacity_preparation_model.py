@@ -18,14 +18,22 @@ The optimization uses Gurobi to minimize:
 import gurobipy as gp
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import datetime
 import warnings
 import pytz
+from helperfunctions.gurobi_environment import gurobi_env
 
 def capacity_tariffs_preparation(charging_session_data, timesteplist, DA_prices, dynamic_retail_prices_considered, capacity_tariff):
     """
     Optimize EV charging under a capacity tariff (monthly peak pricing).
 
+    The monthly peaks are only linked through sessions that charge in more than one month. The months are
+    therefore split into groups of linked months, which are optimized as separate (smaller) models in parallel.
+
     Args:
         charging_session_data (pd.DataFrame): DataFrame containing EV session details (arrival time, departure time, max power, demand in kWh).
         timesteplist (list): List of datetime timestamps representing available charging periods.
@@ -37,15 +45,9 @@ def capacity_tariffs_preparation(charging_session_data, timesteplist, DA_prices,
         dict: Dictionary with months as keys (1-12) and corresponding optimized peak power values (kW) as values.
     """
 
-    # Initialize a results DataFrame (index = time steps)
-    resultdf = pd.DataFrame(index=timesteplist)
-    
     # Dictionary to hold monthly timesteps (for each month)
     timestepdict = {}
 
-    # Large number to scale the priority cost
-    M = 1e9
-
     # Create a list of all 15-minute intervals for each month
     for month in range(1, 13):
         start_date_month = datetime.datetime(2022, month, 1, tzinfo=pytz.timezone('CET'))
@@ -55,108 +57,181 @@ def capacity_tariffs_preparation(charging_session_data, timesteplist, DA_prices,
             end_date_month = datetime.datetime(2023, 1, 1, tzinfo=pytz.timezone('CET'))  # For December
         timestepdict[month] = pd.date_range(start=start_date_month, end=end_date_month, freq='15Min', tz='CET')
 
+    # Convert timesteplist into a Pandas DatetimeIndex
+    timesteps_index = pd.DatetimeIndex(timesteplist)
+
+    # Position of the first timestep within and the first timestep after each session window
+    first_t = timesteps_index.searchsorted(charging_session_data['Arrival time'], side='left')
+    last_t = np.maximum(timesteps_index.searchsorted(charging_session_data['Departure time'], side='left'), first_t)
+
+    # Positions of the timesteps of each month, and whether each session charges in that month
+    month_positions = {}
+    session_in_month = {}
+    for month in range(1, 13):
+        in_month = timesteps_index.isin(timestepdict[month])
+        month_positions[month] = np.flatnonzero(in_month)
+        n_in_month_before = np.concatenate([[0], np.cumsum(in_month)])
+        session_in_month[month] = n_in_month_before[last_t] > n_in_month_before[first_t]
+
+    # Merge the months that are linked by a session charging in both months into groups
+    month_group = {month: {month} for month in range(1, 13)}
+    session_months = np.column_stack([session_in_month[month] for month in range(1, 13)])
+    for months_of_session in {tuple(np.flatnonzero(row) + 1) for row in session_months}:
+        merged_group = set().union(*(month_group[month] for month in months_of_session))
+        for month in merged_group:
+            month_group[month] = merged_group
+    groups = sorted({tuple(sorted(group)) for group in month_group.values()})
+
+    # Input of the model of each group: the sessions charging in the group's months (sessions that do not charge
+    # in any month do not affect the peaks) and the timesteps spanned by these months and sessions.
+    # Nothing charges in the months of a group without sessions, so their peaks are 0 and no model is needed.
+    peakdict = {}
+    group_inputs = []
+    for months in groups:
+        sessions = np.flatnonzero(np.any([session_in_month[month] for month in months], axis=0))
+        if len(sessions) == 0:
+            for month in months:
+                peakdict[month] = 0.0
+            continue
+        positions = np.concatenate([month_positions[month] for month in months] + [first_t[sessions], last_t[sessions] - 1])
+        lo, hi = positions.min(), positions.max() + 1
+        group_inputs.append((
+            charging_session_data.iloc[sessions],
+            timesteps_index[lo:hi],
+            {month: timestepdict[month] for month in months},
+            DA_prices,
+            dynamic_retail_prices_considered,
+            capacity_tariff,
+        ))
+
+    # Optimize the groups in parallel and combine the monthly peaks. The worker processes are started with 'spawn',
+    # so that each process starts its own Gurobi environment instead of inheriting the environment of this process.
+    # There are usually only a few groups, so the available cores are divided over the models of the groups.
+    if len(group_inputs) > 0:
+        threads = max(1, os.cpu_count() // len(group_inputs))
+        with ProcessPoolExecutor(max_workers=min(len(group_inputs), os.cpu_count()), mp_context=multiprocessing.get_context('spawn')) as executor:
+            for group_peakdict in executor.map(capacity_tariffs_preparation_months, *zip(*group_inputs), [threads] * len(group_inputs)):
+                peakdict.update(group_peakdict)
+
+    return dict(sorted(peakdict.items()))
+
+
+def capacity_tariffs_preparation_months(charging_session_data, timesteplist, timestepdict, DA_prices, dynamic_retail_prices_considered, capacity_tariff, threads=0):
+    """
+    Optimize EV charging under a capacity tariff for a group of months, of which the peaks are not linked
+    to those of the other months.
+
+    Args:
+        charging_session_data (pd.DataFrame): DataFrame containing EV session details (arrival time, departure time, max power, demand in kWh).
+        timesteplist (list): List of datetime timestamps covering the months and the session windows.
+        timestepdict (dict): Dictionary with the months of the group as keys and their timesteps as values.
+        DA_prices (pd.DataFrame): DataFrame containing day-ahead electricity prices (€/MWh).
+        dynamic_retail_prices_considered (bool): If True, account for dynamic retail prices in the optimization objective.
+        capacity_tariff (float): Annual grid capacity tariff (cost per kW per year).
+        threads (int): Number of threads Gurobi may use for this model (0 lets Gurobi decide).
+
+    Returns:
+        dict: Dictionary with the months of the group as keys and corresponding optimized peak power values (kW) as values.
+    """
+
+    # Months of this group
+    months = sorted(timestepdict)
+
+    # Large number to scale the priority cost
+    M = 1e9
+
     # 15-minute time resolution in hours
     delta_t = 0.25
 
     # Initialize Gurobi optimization model
-    m = gp.Model()
-    m.Params.outputFlag = 0  # Suppress Gurobi output
-    m.Params.LogToConsole = 0
-
-    # Initialize variables
-    p_ch_session = {}  # Charging power (kW) for each session at each timestep
-    C_DA_session = {}  # Day-ahead price cost for each session
-    C_DA_tot = m.addVar(lb=-np.inf)  # Total day-ahead costs
-    p_tot = {}  # Total charging power at each timestep
-    p_peak = {}  # Peak power per month
-    C_priority_session = {}  # Priority term per session (to encourage early charging)
-    C_priority_tot = m.addVar(lb=-np.inf)  # Total priority term
-    C_grid = m.addVar(lb=-np.inf)  # Total grid cost
+    m = gp.Model(env=gurobi_env)
+    m.Params.Threads = threads  # Share of the cores for this group, as the groups of months are solved in parallel
 
     # Convert timesteplist into a Pandas DatetimeIndex
     timesteps_index = pd.DatetimeIndex(timesteplist)
+    n_timesteps = len(timesteps_index)
+    n_sessions = len(charging_session_data)
+
+    # Session characteristics as NumPy arrays (one entry per session)
+    p_max = charging_session_data['Max. charging power (kW)'].to_numpy(dtype=float)
+    vol = charging_session_data['Charging demand (kWh)'].to_numpy(dtype=float)
+
+    # Position of the first timestep within and the first timestep after each session window
+    first_t = timesteps_index.searchsorted(charging_session_data['Arrival time'], side='left')
+    last_t = timesteps_index.searchsorted(charging_session_data['Departure time'], side='left')
+    n_timesteps_session = np.maximum(last_t - first_t, 0)
+
+    # Flatten all (session, timestep) combinations within the session windows into "cells".
+    # For each cell we store the session it belongs to, its position within the session window
+    # (0 at arrival) and its position in timesteplist.
+    n_cells = int(n_timesteps_session.sum())
+    session_of_cell = np.repeat(np.arange(n_sessions), n_timesteps_session)
+    position_in_session = np.arange(n_cells) - np.repeat(np.cumsum(n_timesteps_session) - n_timesteps_session, n_timesteps_session)
+    t_of_cell = first_t[session_of_cell] + position_in_session
+
+    # Charging power (kW) for each session at each timestep of its session window
+    p_ch = m.addMVar(n_cells, lb=0, ub=p_max[session_of_cell])
+
+    # Total charging power at each timestep
+    p_tot = m.addMVar(n_timesteps, lb=0)
+
+    # Peak power per month (in the order of months)
+    p_peak = m.addMVar(len(months))
+
+    if n_cells > 0:
+        # Enforce that total energy charged matches demand for every session
+        A_session = sp.csr_matrix((np.full(n_cells, delta_t), (session_of_cell, np.arange(n_cells))), shape=(n_sessions, n_cells))
+        m.addMConstr(A_session, p_ch, '=', vol)
+
+        # Total power at each timestep is the sum over all sessions active at that timestep
+        A_tot = sp.csr_matrix((np.ones(n_cells), (t_of_cell, np.arange(n_cells))), shape=(n_timesteps, n_cells))
+        m.addConstr(p_tot == A_tot @ p_ch)
+    else:
+        # No session charges, so the total power is 0 at every timestep
+        m.addConstr(p_tot == 0)
 
-    # Define variables and constraints for each charging session
-    for session in charging_session_data.index:
-        # Session characteristics
-        arrival_time = charging_session_data.loc[session, 'Arrival time']
-        departure_time = charging_session_data.loc[session, 'Departure time']
-        p_max = charging_session_data.loc[session, 'Max. charging power (kW)']
-        vol = charging_session_data.loc[session, 'Charging demand (kWh)']
-
-        # Filter timesteps within the session window
-        timesteplist_session = timesteps_index[(timesteps_index >= arrival_time) & (timesteps_index < departure_time)]
-
-        # Define charging power variables for each timestep of this session
-        p_ch_session[session] = m.addVars(timesteplist_session, lb=0, ub=p_max)
-
-        # Enforce that total energy charged matches demand
-        m.addConstr(gp.quicksum(p_ch_session[session][t] * delta_t for t in timesteplist_session) == vol)
-
-        # If dynamic pricing is considered, define session-specific DA cost
-        if dynamic_retail_prices_considered:
-            C_DA_session[session] = m.addVar(lb=-np.inf)
-            m.addConstr(C_DA_session[session] == gp.quicksum(
-                p_ch_session[session][t] * delta_t *
-                DA_prices.loc[t - datetime.timedelta(minutes=t.minute), 'Day-ahead price (€/MWh)'] / 1000
-                for t in timesteplist_session
-            ))
-
-        # Priority cost term for this session (penalizes late charging)
-        C_priority_session[session] = m.addVar(lb=-np.inf)
-        m.addConstr(
-            C_priority_session[session] == gp.quicksum(
-                p_ch_session[session][timesteplist_session[i]] * i for i in range(len(timesteplist_session))
-            )
-        )
-
-    # Define total power at each timestep across all sessions
-    for t in timesteplist:
-        # Sessions active at this timestep
-        charging_sessions_active_at_t = charging_session_data[
-            (charging_session_data['Arrival time'] <= t) & (charging_session_data['Departure time'] > t)
-        ]
-
-        # Total power at timestep t
-        p_tot[t] = m.addVar(lb=0)
-        m.addConstr(p_tot[t] == gp.quicksum(
-            p_ch_session[session][t] for session in list(charging_sessions_active_at_t.index)
-        ))
-
-    # Define monthly peak variables
-    for month in range(1, 13):
-        # Peak power for the month
-        p_peak[month] = m.addVar()
+    # Peak must be at least as large as any individual timestep in that month
+    for month_pos, month in enumerate(months):
+        month_positions = np.flatnonzero(timesteps_index.isin(timestepdict[month]))
+        if len(month_positions) > 0:
+            m.addConstr(p_tot[month_positions] <= p_peak[month_pos])
 
-        # Peak must be at least as large as any individual timestep in that month
-        m.addConstrs(p_tot[t] <= p_peak[month] for t in timestepdict[month])
+    # Total grid cost = sum of monthly peak fees
+    C_grid = p_peak.sum() * capacity_tariff / 12
 
-    # Priority cost constraint (sum over all sessions)
-    m.addConstr(C_priority_tot == gp.quicksum(C_priority_session[session] for session in list(charging_session_data.index)))
+    # Priority cost term (penalizes late charging)
+    if n_cells > 0:
+        C_priority_tot = position_in_session @ p_ch
+    else:
+        C_priority_tot = 0
 
     # Define the objective function
     if dynamic_retail_prices_considered:
-        # Total day-ahead cost constraint
-        m.addConstr(C_DA_tot == gp.quicksum(C_DA_session[session] for session in list(charging_session_data.index)))
+        # Day-ahead price (€/kWh) of the hour each timestep falls in
+        DA_price_at_t = DA_prices['Day-ahead price (€/MWh)'].reindex(
+            timesteps_index - pd.to_timedelta(timesteps_index.minute, unit='min')
+        ).to_numpy() / 1000
 
-        # Total grid cost = sum of monthly peak fees
-        m.addConstr(C_grid == gp.quicksum(p_peak[month] * capacity_tariff / 12 for month in range(1, 13)))
+        # Total day-ahead cost
+        if n_cells > 0:
+            C_DA_tot = (DA_price_at_t[t_of_cell] * delta_t) @ p_ch
+        else:
+            C_DA_tot = 0
 
         # Objective: minimize total cost (DA + grid + priority term)
         obj = C_DA_tot + C_grid + C_priority_tot / M
     else:
         # Grid cost only if no dynamic prices
-        m.addConstr(C_grid == gp.quicksum(p_peak[month] * capacity_tariff / 12 for month in range(1, 13)))
         obj = C_grid + C_priority_tot / M
 
     # Set and optimize the objective function
     m.setObjective(obj, gp.GRB.MINIMIZE)
-    m.update()
     m.optimize()
 
     # Retrieve optimized peak values for each month
+    p_peak_values = p_peak.X
     peakdict = {}
-    for month in range(1, 13):
-        peakdict[month] = p_peak[month].X
+    for month_pos, month in enumerate(months):
+        peakdict[month] = float(p_peak_values[month_pos])
 
     return peakdict
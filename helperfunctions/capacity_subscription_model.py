@@ -3,9 +3,10 @@
 import gurobipy as gp
 import pandas as pd
 import numpy as np
-import datetime
+import scipy.sparse as sp
 import warnings
 import pytz
+from helperfunctions.gurobi_environment import gurobi_env
 
 def capacity_subscription(charging_session_data, timesteplist, CS, DA_prices, dynamic_retail_prices_considered, exceedance_fee, subscribed_capacity):
     """
@@ -25,123 +26,153 @@ def capacity_subscription(charging_session_data, timesteplist, CS, DA_prices, dy
         pd.DataFrame: DataFrame indexed by timestep with optimized total power (column CS).
     """
 
-    # Initialize result dataframe
-    resultdf = pd.DataFrame(index=timesteplist)
+    m, handles = build_subscription_model(charging_session_data, timesteplist, DA_prices, dynamic_retail_prices_considered)
+
+    return solve_subscription(m, handles, CS, exceedance_fee, subscribed_capacity)
+
+
+def build_subscription_model(charging_session_data, timesteplist, DA_prices, dynamic_retail_prices_considered):
+    """
+    Build the capacity-subscription optimization model, without the exceedance fee and subscribed capacity.
+    These are set by solve_subscription, so that the same model can be solved for different values.
+
+    Args:
+        charging_session_data (pd.DataFrame): EV sessions, including arrival/departure, max charging power, and demand (kWh).
+        timesteplist (list): List of datetime timestamps representing discrete optimization periods.
+        DA_prices (pd.DataFrame): DataFrame indexed by time, containing the day-ahead market prices (€/MWh).
+        dynamic_retail_prices_considered (bool): Whether to include dynamic energy prices in the objective.
+
+    Returns:
+        tuple: Gurobi model and dictionary with the timesteplist, the timesteps with active sessions ('active_timesteps') and the
+            MVars of the total, subscribed and exceedance power at these timesteps ('p_tot', 'p_subscribed_capacity', 'p_exceedance')
+            to pass to solve_subscription.
+    """
 
     # Time resolution in hours (15 min)
     delta_t = 0.25
 
+    # Large number for priority scaling
+    M = 1e9
+
     # Create Gurobi model
-    m = gp.Model()
-    m.Params.outputFlag = 0  # Suppress Gurobi output
-    m.Params.LogToConsole = 0
-
-    # Initialize variables
-    p_ch_session = {}     # Charging power per session
-    C_DA_session = {}     # Energy cost per session
-    C_DA_tot = m.addVar(lb=-np.inf)  # Total energy cost
-    p_tot = {}            # Total charging power at each timestep
-    p_subscribed_capacity = {}  # Charging power within subscribed limit
-    p_exceedance = {}     # Charging power exceeding subscribed limit
-    C_grid = m.addVar(lb=-np.inf)  # Exceedance cost
-    M = 1e9               # Large number for priority scaling
-    C_priority_session = {}  # Priority cost per session
-    C_priority_tot = m.addVar(lb=-np.inf)  # Total priority cost
+    m = gp.Model(env=gurobi_env)
 
     # Convert timesteplist into a DatetimeIndex
     timesteps_index = pd.DatetimeIndex(timesteplist)
-
-    # Create variables and constraints for each charging session
-    for session in list(charging_session_data.index):
-        # Session characteristics
-        arrival_time = charging_session_data.loc[session, 'Arrival time']
-        departure_time = charging_session_data.loc[session, 'Departure time']
-        p_max = charging_session_data.loc[session, 'Max. charging power (kW)']
-        vol = charging_session_data.loc[session, 'Charging demand (kWh)']
-
-        # Relevant timesteps for this session
-        timesteplist_session = timesteps_index[
-            (timesteps_index >= arrival_time) & (timesteps_index < departure_time)
-        ]
-
-        # Charging power variable for each active timestep
-        p_ch_session[session] = m.addVars(timesteplist_session, lb=0, ub=p_max)
-
-        # Charging demand constraint (energy must match requested volume)
-        m.addConstr(
-            gp.quicksum(p_ch_session[session][t] * delta_t for t in timesteplist_session) == vol
-        )
-
-        # Priority term to favor early charging
-        C_priority_session[session] = m.addVar(lb=-np.inf)
-        m.addConstr(
-            C_priority_session[session] == gp.quicksum(
-                p_ch_session[session][timesteplist_session[i]] * i for i in range(len(timesteplist_session))
-            )
-        )
-
-        # Dynamic pricing cost per session
-        if dynamic_retail_prices_considered:
-            C_DA_session[session] = m.addVar(lb=-np.inf)
-            m.addConstr(
-                C_DA_session[session] == gp.quicksum(
-                    p_ch_session[session][t] * delta_t *
-                    DA_prices.loc[t - datetime.timedelta(minutes=t.minute), 'Day-ahead price (€/MWh)'] / 1000
-                    for t in timesteplist_session
-                )
-            )
-
-    # Create variables and constraints for each timestep
-    for t in timesteplist:
-        # Find active sessions at timestep t
-        charging_sessions_active_at_t = charging_session_data[
-            (charging_session_data['Arrival time'] <= t) & (charging_session_data['Departure time'] > t)
-        ]
-
-        # Define variables
-        p_tot[t] = m.addVar(lb=0)
-        p_subscribed_capacity[t] = m.addVar(lb=0, ub=subscribed_capacity)
-        p_exceedance[t] = m.addVar(lb=0)
-
-        # Total power constraint
-        m.addConstr(
-            p_tot[t] == gp.quicksum(
-                p_ch_session[session][t] for session in list(charging_sessions_active_at_t.index)
-            )
-        )
-
-        # Decompose total power into subscribed and exceedance parts
-        m.addConstr(
-            p_tot[t] == p_subscribed_capacity[t] + p_exceedance[t]
-        )
-
-    # Priority cost constraint
-    m.addConstr(
-        C_priority_tot == gp.quicksum(C_priority_session[session] for session in charging_session_data.index)
-    )
-
-    # Objective function definition
+    n_timesteps = len(timesteps_index)
+
+    # Session characteristics as NumPy arrays, indexed by the position of the session
+    n_sessions = len(charging_session_data)
+    p_max_session = charging_session_data['Max. charging power (kW)'].to_numpy(dtype=float)
+    vol_session = charging_session_data['Charging demand (kWh)'].to_numpy(dtype=float)
+
+    # Position of the first timestep within and the first timestep after each session window
+    # The timesteps of a session are the slice first_t:last_t of timesteplist
+    first_t = timesteps_index.searchsorted(charging_session_data['Arrival time'], side='left')
+    last_t = timesteps_index.searchsorted(charging_session_data['Departure time'], side='left')
+    n_timesteps_session = np.maximum(last_t - first_t, 0)
+
+    # Flatten all (session, timestep) combinations within the session windows into "cells".
+    # For each cell we store the session it belongs to, its position within the session window
+    # (0 at arrival) and its position in timesteplist.
+    n_cells = int(n_timesteps_session.sum())
+    session_of_cell = np.repeat(np.arange(n_sessions), n_timesteps_session)
+    position_in_session = np.arange(n_cells) - np.repeat(np.cumsum(n_timesteps_session) - n_timesteps_session, n_timesteps_session)
+    t_of_cell = first_t[session_of_cell] + position_in_session
+
+    # Positions of the timesteps with active sessions. The total power at the other timesteps
+    # is 0, so these are left out of the model
+    active_positions = np.flatnonzero(np.bincount(t_of_cell, minlength=n_timesteps) > 0)
+    n_active = len(active_positions)
+    row_of_t = np.full(n_timesteps, -1)
+    row_of_t[active_positions] = np.arange(n_active)
+
+    # Charging power per session at each timestep of its session window
+    p_ch = m.addMVar(n_cells, lb=0, ub=p_max_session[session_of_cell])
+
+    # Charging demand constraint (energy must match requested volume)
+    A_session = sp.csr_matrix((np.full(n_cells, delta_t), (session_of_cell, np.arange(n_cells))), shape=(n_sessions, n_cells))
+    m.addMConstr(A_session, p_ch, '=', vol_session)
+
+    # Total charging power, charging power within subscribed limit and charging power exceeding
+    # subscribed limit at each timestep with active sessions
+    p_tot = m.addMVar(n_active, lb=0)
+    p_subscribed_capacity = m.addMVar(n_active, lb=0)  # Upper bound is set to the subscribed capacity
+    p_exceedance = m.addMVar(n_active, lb=0)  # Objective coefficient is set to the exceedance fee
+
+    # Total power constraint, and decomposition of total power into subscribed and exceedance parts
+    if n_active > 0:
+        A_tot = sp.csr_matrix((np.ones(n_cells), (row_of_t[t_of_cell], np.arange(n_cells))), shape=(n_active, n_cells))
+        m.addConstr(p_tot == A_tot @ p_ch)
+        m.addConstr(p_tot == p_subscribed_capacity + p_exceedance)
+
+    # Priority term to favor early charging
+    C_priority_tot = position_in_session @ p_ch
+
+    # Objective function definition. The exceedance costs are added as objective coefficients
+    # of the exceedance variables when solving the model.
     if dynamic_retail_prices_considered:
-        m.addConstr(
-            C_DA_tot == gp.quicksum(C_DA_session[session] for session in charging_session_data.index)
-        )
-        m.addConstr(
-            C_grid == gp.quicksum(p_exceedance[t] * exceedance_fee * delta_t for t in timesteplist)
-        )
-        obj = C_DA_tot + C_grid + C_priority_tot / M
+        # Day-ahead price (€/kWh) of the hour each timestep falls in
+        DA_price_at_t = DA_prices['Day-ahead price (€/MWh)'].reindex(
+            timesteps_index - pd.to_timedelta(timesteps_index.minute, unit='min')
+        ).to_numpy() / 1000
+
+        # Total energy cost
+        C_DA_tot = (DA_price_at_t[t_of_cell] * delta_t) @ p_ch
+        obj = C_DA_tot + C_priority_tot / M
     else:
-        m.addConstr(
-            C_grid == gp.quicksum(p_exceedance[t] * exceedance_fee * delta_t for t in timesteplist)
-        )
-        obj = C_grid + C_priority_tot / M
-
-    # Set and solve the optimization model
+        obj = C_priority_tot / M
     m.setObjective(obj, gp.GRB.MINIMIZE)
-    m.update()
+
+    handles = {
+        'timesteplist': timesteplist,
+        'active_timesteps': timesteps_index[active_positions],
+        'p_tot': p_tot,
+        'p_subscribed_capacity': p_subscribed_capacity,
+        'p_exceedance': p_exceedance,
+    }
+
+    return m, handles
+
+
+def solve_subscription(m, handles, CS, exceedance_fee, subscribed_capacity):
+    """
+    Solve a model created by build_subscription_model for the given exceedance fee and subscribed capacity.
+    Only the variable bounds and objective coefficients are updated, so that Gurobi can start from
+    the solution of the previous solve. The LP is degenerate, so this can give a different optimal
+    charging profile (with the same costs) than a fresh solve, depending on the previous solves.
+
+    Args:
+        m (gp.Model): Model returned by build_subscription_model.
+        handles (dict): Dictionary returned by build_subscription_model.
+        CS (str): Name for the column that stores total charging power in the results.
+        exceedance_fee (float): Penalty cost (€/kWh) for energy consumption exceeding subscribed capacity.
+        subscribed_capacity (float): Subscribed maximum allowable charging power (kW).
+
+    Returns:
+        pd.DataFrame: DataFrame indexed by timestep with optimized total power (column CS).
+    """
+
+    # Initialize result dataframe (0 at timesteps without active sessions)
+    timesteplist = handles['timesteplist']
+    resultdf = pd.DataFrame(0.0, index=timesteplist, columns=[CS])
+
+    # Time resolution in hours (15 min)
+    delta_t = 0.25
+
+    # Set the subscribed capacity and the exceedance costs
+    handles['p_subscribed_capacity'].UB = subscribed_capacity
+    handles['p_exceedance'].Obj = exceedance_fee * delta_t
+
+    # Solve the optimization model. After the first solve, dual simplex restarts from the optimal
+    # basis of the previous solve, which the model keeps after the bound and objective changes.
+    if m.SolCount > 0:
+        m.Params.Method = 1
+        m.Params.LPWarmStart = 2
     m.optimize()
 
-    # Store results
-    for t in timesteplist:
-        resultdf.at[t, CS] = round(p_tot[t].X, 1)
+    # Store results, retrieving the total power at all timesteps with active sessions in one call
+    if len(handles['active_timesteps']) > 0:
+        resultdf.loc[handles['active_timesteps'], CS] = np.round(handles['p_tot'].X, 1)
 
     return resultdf
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+Gurobi environment shared by all optimization models in the helperfunctions, so that the
+environment (including the license check) only has to be started once per process.
+"""
+
+import gurobipy as gp
+
+gurobi_env = gp.Env(empty=True)
+gurobi_env.setParam('OutputFlag', 0)  # Suppress Gurobi output
+gurobi_env.start()
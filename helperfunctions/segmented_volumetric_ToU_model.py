@@ -8,10 +8,10 @@ Created on Fri Apr 25 17:39:20 2025
 import gurobipy as gp
 import pandas as pd
 import numpy as np
-import datetime
-import warnings
+import scipy.sparse as sp
 import pytz
-warnings.filterwarnings('ignore')
+from helperfunctions.gurobi_environment import gurobi_env
+
 def segmented_volumetric_ToU(charging_session_data, timesteplist, CS, grid_tariff_threshold_df, DA_prices, dynamic_retail_prices_considered, low_tariff, medium_tariff, high_tariff):
     """
     Function to solve a segmented volumetric time-of-use (ToU) optimization problem for electric vehicle (EV) charging sessions.
@@ -30,11 +30,60 @@ def segmented_volumetric_ToU(charging_session_data, timesteplist, CS, grid_tarif
         pd.DataFrame: DataFrame containing the optimized charging power for each time step at the given charging station.
     """
 
-    # Initialize an empty DataFrame to store results, with all values initially set to 0.
-    resultdf = pd.DataFrame(0, index=timesteplist, columns=[CS])
+    m, handles = build_segmented_volumetric_ToU_model(charging_session_data, timesteplist, grid_tariff_threshold_df, DA_prices, dynamic_retail_prices_considered)
+
+    return solve_segmented_volumetric_ToU(m, handles, CS, low_tariff, medium_tariff, high_tariff)
+
+
+def build_segmented_volumetric_ToU_model(charging_session_data, timesteplist, grid_tariff_threshold_df, DA_prices, dynamic_retail_prices_considered):
+    """
+    Function to build the segmented volumetric ToU optimization model without the tariff values, which are set by
+    solve_segmented_volumetric_ToU. This allows solving the same model for different tariff values.
+    
+    Args:
+        charging_session_data (pd.DataFrame): DataFrame containing charging session details such as arrival and departure times, maximum charging power, and charging demand (in kWh).
+        timesteplist (list): List of timestamps representing the grid's time resolution for the optimization process.
+        grid_tariff_df (pd.DataFrame): DataFrame with the grid tariff information, including thresholds for price categories.
+        DA_prices (pd.DataFrame): Day-ahead prices for energy, with a column for price values.
+        dynamic_retail_prices_considered (bool): Flag to indicate whether dynamic retail prices should be considered in the optimization.
+    Returns:
+        tuple: The Gurobi model and a dictionary with the timesteplist, the timesteps with active sessions ('active_timesteps') and the
+            MVars of the total power and price categories at these timesteps ('p_tot', 'p_tot_pricecat1', 'p_tot_pricecat2', 'p_tot_pricecat3')
+            to pass to solve_segmented_volumetric_ToU.
+    """
 
     # Convert timesteplist to a pandas DatetimeIndex to facilitate time-based slicing.
     timesteps_index = pd.DatetimeIndex(timesteplist)
+    n_timesteps = len(timesteps_index)
+
+    # Session characteristics as NumPy arrays, indexed by the position of the session.
+    n_sessions = len(charging_session_data)
+    p_max_session = charging_session_data['Max. charging power (kW)'].to_numpy(dtype=float)
+    vol_session = charging_session_data['Charging demand (kWh)'].to_numpy(dtype=float)
+
+    # Position of the first timestep within and the first timestep after each session window.
+    # The timesteps of a session are the slice first_t:last_t of timesteplist.
+    first_t = timesteps_index.searchsorted(charging_session_data['Arrival time'], side='left')
+    last_t = timesteps_index.searchsorted(charging_session_data['Departure time'], side='left')
+    n_timesteps_session = np.maximum(last_t - first_t, 0)
+
+    # Flatten all (session, timestep) combinations within the session windows into "cells". For each cell we store the
+    # session it belongs to, its position within the session window (0 at arrival) and its position in timesteplist.
+    n_cells = int(n_timesteps_session.sum())
+    session_of_cell = np.repeat(np.arange(n_sessions), n_timesteps_session)
+    position_in_session = np.arange(n_cells) - np.repeat(np.cumsum(n_timesteps_session) - n_timesteps_session, n_timesteps_session)
+    t_of_cell = first_t[session_of_cell] + position_in_session
+
+    # Positions of the timesteps with active sessions in timesteplist. Timesteps without active sessions are left out of
+    # the model, as the total charging power is 0 at these timesteps.
+    active_positions = np.flatnonzero(np.bincount(t_of_cell, minlength=n_timesteps) > 0)
+    n_active = len(active_positions)
+    row_of_t = np.full(n_timesteps, -1)
+    row_of_t[active_positions] = np.arange(n_active)
+
+    # Thresholds of the price categories as compact float32 arrays, in the order of timesteplist.
+    threshold_1 = grid_tariff_threshold_df['Threshold_1'].reindex(timesteps_index).to_numpy(dtype=np.float32)
+    threshold_2 = grid_tariff_threshold_df['Threshold_2'].reindex(timesteps_index).to_numpy(dtype=np.float32)
     
     # Time resolution (15 minutes = 0.25 hours).
     delta_t = 0.25
@@ -43,90 +92,100 @@ def segmented_volumetric_ToU(charging_session_data, timesteplist, CS, grid_tarif
     M = 1e9
     
     # Initialize a Gurobi model to formulate the optimization problem.
-    m = gp.Model()
-    m.Params.outputFlag = 0  # Suppresses all Gurobi output.
-    m.Params.LogToConsole = 0
+    m = gp.Model(env=gurobi_env)
     
-    # Dictionaries to hold variables for charging sessions, cost terms, and power totals.
-    p_ch_session = {}  # Dictionary to store charging power for each session at each timestep.
-    C_DA_session = {}  # Dictionary to store day-ahead price-related costs for each charging session.
-    C_DA_tot = m.addVar(lb=-np.inf)  # Total day-ahead cost for all charging sessions.
-    p_tot = {}  # Dictionary to store total charging power at each timestep.
-    p_tot_pricecat1 = {}  # Dictionary to store charging power for the first price category at each timestep.
-    p_tot_pricecat2 = {}  # Dictionary to store charging power for the second price category at each timestep.
-    p_tot_pricecat3 = {}  # Dictionary to store charging power for the third price category at each timestep.
-    C_grid = m.addVar(lb=-np.inf)  # Total grid tariff cost.
-    C_priority_session = {}  # Dictionary to store the priority cost term for each charging session.
-    C_priority_tot = m.addVar(lb=-np.inf)  # Total priority cost for all sessions.
-    
-    # Loop over each charging session to define variables and constraints.
-    for session in charging_session_data.index:
-        # Extract session details from the input data.
-        arrival_time = charging_session_data.loc[session, 'Arrival time']
-        departure_time = charging_session_data.loc[session, 'Departure time']
-        p_max = charging_session_data.loc[session, 'Max. charging power (kW)']
-        vol = charging_session_data.loc[session, 'Charging demand (kWh)']
-
-        # Filter timesteps that fall within this session's arrival and departure times.
-        timesteplist_session = timesteps_index[(timesteps_index >= arrival_time) & (timesteps_index < departure_time)]
-        
-        # Add a variable for the charging power at each timestep for the current session.
-        p_ch_session[session] = m.addVars(timesteplist_session, lb=0, ub=p_max)
-        
-        # Add a constraint ensuring that the total charging power over the session matches the charging demand.
-        m.addConstr(gp.quicksum(p_ch_session[session][t] * delta_t for t in timesteplist_session) == vol)
-        
-        # Add a variable for the priority cost term related to this session.
-        C_priority_session[session] = m.addVar(lb=-np.inf)
-        m.addConstr(C_priority_session[session] == gp.quicksum(p_ch_session[session][timesteplist_session[i]] * i for i in range(len(timesteplist_session))))
-
-        # If dynamic retail prices are considered, add a cost term for day-ahead prices.
-        if dynamic_retail_prices_considered:
-            C_DA_session[session] = m.addVar(lb=-np.inf)
-            m.addConstr(C_DA_session[session] == gp.quicksum(p_ch_session[session][t] * delta_t * DA_prices.loc[t - datetime.timedelta(minutes=t.minute), 'Day-ahead price (€/MWh)'] / 1000 for t in timesteplist_session))
-
-    # Loop over each timestep to calculate total charging power and costs.
-    for t in timesteplist:
-        # Identify the charging sessions active at the current timestep.
-        charging_sessions_active_at_t = charging_session_data[(charging_session_data['Arrival time'] <= t) & (charging_session_data['Departure time'] > t)]
-        
-        # Add variables for total charging power and price categories at each timestep.
-        p_tot[t] = m.addVar(lb=0)
-        p_tot_pricecat1[t] = m.addVar(lb=0, ub=grid_tariff_threshold_df.loc[t, 'Threshold_1'])
-        p_tot_pricecat2[t] = m.addVar(lb=0, ub=grid_tariff_threshold_df.loc[t, 'Threshold_2'])
-        p_tot_pricecat3[t] = m.addVar(lb=0)
-        
-        # Add constraints for total charging power and price category sums.
-        m.addConstr(p_tot[t] == gp.quicksum(p_ch_session[session][t] for session in charging_sessions_active_at_t.index))
-        m.addConstr(p_tot[t] == p_tot_pricecat1[t] + p_tot_pricecat2[t] + p_tot_pricecat3[t])
+    # Add a variable for the charging power of each session at each timestep of its session window.
+    p_ch = m.addMVar(n_cells, lb=0, ub=p_max_session[session_of_cell])
+
+    # Add a constraint for each session ensuring that the total charging power over the session matches the charging demand.
+    A_session = sp.csr_matrix((np.full(n_cells, delta_t), (session_of_cell, np.arange(n_cells))), shape=(n_sessions, n_cells))
+    m.addMConstr(A_session, p_ch, '=', vol_session)
+
+    # Add variables for the total charging power and the price categories at the timesteps with active sessions, with the
+    # thresholds as upper bounds of the first two price categories.
+    p_tot = m.addMVar(n_active, lb=0)
+    p_tot_pricecat1 = m.addMVar(n_active, lb=0, ub=threshold_1[active_positions])
+    p_tot_pricecat2 = m.addMVar(n_active, lb=0, ub=threshold_2[active_positions])
+    p_tot_pricecat3 = m.addMVar(n_active, lb=0)
+
+    # Add matrix constraints for the total charging power (the sum over the active sessions) and the price category sums.
+    if n_active > 0:
+        A_tot = sp.csr_matrix((np.ones(n_cells), (row_of_t[t_of_cell], np.arange(n_cells))), shape=(n_active, n_cells))
+        m.addConstr(p_tot == A_tot @ p_ch)
+        m.addConstr(p_tot == p_tot_pricecat1 + p_tot_pricecat2 + p_tot_pricecat3)
     
-    # Add a constraint for the total priority cost across all sessions.
-    m.addConstr(C_priority_tot == gp.quicksum(C_priority_session[session] for session in charging_session_data.index))
+    # Priority cost term, based on the order of the timesteps within each session.
+    C_priority_tot = position_in_session @ p_ch
     
-    # Add constraints for dynamic retail prices if applicable.
+    # The grid tariff costs are added as objective coefficients of the price category variables when solving the model.
     if dynamic_retail_prices_considered:
-        m.addConstr(C_DA_tot == gp.quicksum(C_DA_session[session] for session in charging_session_data.index))
-        m.addConstr(C_grid == gp.quicksum(p_tot_pricecat1[t] * low_tariff * delta_t for t in timesteplist) +
-                    gp.quicksum(p_tot_pricecat2[t] * medium_tariff * delta_t for t in timesteplist) +
-                    gp.quicksum(p_tot_pricecat3[t] * high_tariff * delta_t for t in timesteplist))
+        # Day-ahead price (€/kWh) of the hour each timestep falls in.
+        DA_price_at_t = DA_prices['Day-ahead price (€/MWh)'].reindex(
+            timesteps_index - pd.to_timedelta(timesteps_index.minute, unit='min')
+        ).to_numpy() / 1000
+
+        # Total day-ahead cost for all charging sessions.
+        C_DA_tot = (DA_price_at_t[t_of_cell] * delta_t) @ p_ch
         
-        # Define the objective function (minimizing total cost including day-ahead prices, grid costs, and priority costs).
-        obj = C_DA_tot + C_grid + C_priority_tot / M
+        # Define the objective function (minimizing total cost including day-ahead prices and priority costs).
+        obj = C_DA_tot + C_priority_tot / M
     else:
-        # Define the objective function (minimizing total cost including grid costs and priority costs).
-        m.addConstr(C_grid == gp.quicksum(p_tot_pricecat1[t] * low_tariff * delta_t for t in timesteplist) +
-                    gp.quicksum(p_tot_pricecat2[t] * medium_tariff * delta_t for t in timesteplist) +
-                    gp.quicksum(p_tot_pricecat3[t] * high_tariff * delta_t for t in timesteplist))
-        
-        obj = C_grid + C_priority_tot / M
+        # Define the objective function (minimizing the priority costs).
+        obj = C_priority_tot / M
     
-    # Set the objective function to be minimized and solve the model.
+    # Set the objective function to be minimized.
     m.setObjective(obj, gp.GRB.MINIMIZE)
-    m.update()
+
+    handles = {
+        'timesteplist': timesteplist,
+        'active_timesteps': timesteps_index[active_positions],
+        'p_tot': p_tot,
+        'p_tot_pricecat1': p_tot_pricecat1,
+        'p_tot_pricecat2': p_tot_pricecat2,
+        'p_tot_pricecat3': p_tot_pricecat3,
+    }
+
+    return m, handles
+
+
+def solve_segmented_volumetric_ToU(m, handles, CS, low_tariff, medium_tariff, high_tariff):
+    """
+    Function to solve a model created by build_segmented_volumetric_ToU_model for the given tariff values. Only the
+    objective coefficients are updated, so that Gurobi can start from the solution of the previous solve. The LP is
+    degenerate, so this can give a different optimal charging profile (with the same costs) than a fresh solve,
+    depending on the previous solves.
+    
+    Args:
+        m (gp.Model): The model returned by build_segmented_volumetric_ToU_model.
+        handles (dict): The dictionary returned by build_segmented_volumetric_ToU_model.
+        CS (str): Name of the charging station.
+        low_tariff (float): The price per kWh for the consumption at low tariff times/power
+        medium_tariff (float): The price per kWh for the consumption at medium tariff times/power
+        high_tariff (float): The price per kWh for the consumption at high tariff times/power
+    Returns:
+        pd.DataFrame: DataFrame containing the optimized charging power for each time step at the given charging station.
+    """
+
+    # Initialize an empty DataFrame to store results, with all values initially set to 0.
+    timesteplist = handles['timesteplist']
+    resultdf = pd.DataFrame(0.0, index=timesteplist, columns=[CS])
+
+    # Time resolution (15 minutes = 0.25 hours).
+    delta_t = 0.25
+
+    # Set the grid tariff costs of each price category as objective coefficients.
+    for pricecat, tariff in [('p_tot_pricecat1', low_tariff), ('p_tot_pricecat2', medium_tariff), ('p_tot_pricecat3', high_tariff)]:
+        handles[pricecat].Obj = tariff * delta_t
+
+    # Solve the model. After the first solve, the model keeps the optimal basis of the previous solve. As only the objective
+    # coefficients change, this basis remains feasible, so primal simplex can continue from it.
+    if m.SolCount > 0:
+        m.Params.Method = 0
     m.optimize()
     
-    # After optimization, store the results (optimized charging power) in the result dataframe.
-    for t in timesteplist:
-        resultdf.at[t, CS] = round(p_tot[t].X, 1)
+    # After optimization, store the results (optimized charging power) in the result dataframe. The total power
+    # at all timesteps with active sessions is retrieved in one call.
+    if len(handles['active_timesteps']) > 0:
+        resultdf.loc[handles['active_timesteps'], CS] = np.round(handles['p_tot'].X, 1)
 
     return resultdf
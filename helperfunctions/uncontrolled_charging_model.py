@@ -4,6 +4,10 @@ Created on Fri Apr 25 16:27:14 2025
 
 @author: 4013425
 """
+
+import pandas as pd
+import numpy as np
+
 def uncontrolled_charging(charging_session_data, timesteplist):
     """
     In this model, the charging schedules for all considered charging sessions are assigned in an uncontrolled manner,
@@ -31,51 +35,48 @@ def uncontrolled_charging(charging_session_data, timesteplist):
         per timestep per station.
     """
     
-    import pandas as pd
-    import warnings
-    warnings.filterwarnings('ignore')
-    
-    # Create an empty DataFrame with timesteps as index
-    resultdf = pd.DataFrame(index=timesteplist)
-    
     # Time resolution (15 minutes = 0.25 hours)
     delta_t = 0.25
     timesteps_index = pd.DatetimeIndex(timesteplist)
 
-    # Iterate through each unique charging station
-    for CS in charging_session_data['Charging station ID'].unique():
-        # Initialize the column for this charging station with zeros
-        resultdf[CS] = [0] * len(resultdf)
+    # Charging station of each session, encoded as the column of that charging station in the result
+    cs_code, charging_stations = pd.factorize(charging_session_data['Charging station ID'])
+
+    # Session characteristics as NumPy arrays (one entry per session)
+    n_sessions = len(charging_session_data)
+    E_dem = charging_session_data['Charging demand (kWh)'].to_numpy(dtype=float)  # Charging demand (in kWh)
+    P_max = charging_session_data['Max. charging power (kW)'].to_numpy(dtype=float)  # Max charging power (in kW)
+
+    # Positions of the first timestep within and the first timestep after each EV session (arrival to departure)
+    i_start = timesteps_index.searchsorted(charging_session_data['Arrival time'], side='left')
+    i_end = np.maximum(timesteps_index.searchsorted(charging_session_data['Departure time'], side='left'), i_start)
 
-        # Filter sessions for this charging station
-        charging_session_data_sample = charging_session_data[charging_session_data['Charging station ID'] == CS]
+    # Calculate the number of 15-minute timesteps needed to deliver the total energy
+    required_timesteps = E_dem / (P_max * delta_t)
+    n_required_full = required_timesteps.astype(int)
+    remaining_fraction = required_timesteps - n_required_full
 
-        # Iterate through each session
-        for n in charging_session_data_sample.index:
-            # Get timesteps that fall within this EV session (arrival to departure)
-            start = charging_session_data_sample['Arrival time'][n]
-            end = charging_session_data_sample['Departure time'][n]
-            timesteplist_session = timesteps_index[(timesteps_index >= start) & (timesteps_index < end)]
-            # Charging demand (in kWh)
-            E_dem = charging_session_data_sample['Charging demand (kWh)'][n]
-            
-            # Max charging power (in kW)
-            P_max = charging_session_data_sample['Max. charging power (kW)'][n]
-            
-            # Calculate the number of 15-minute timesteps needed to deliver the total energy
-            required_timesteps = E_dem / (P_max * delta_t)
+    # Number of full 15-minute timesteps within each session, and the timestep position and charging station of each of them
+    n_full = np.minimum(n_required_full, i_end - i_start)
+    session_of_full = np.repeat(np.arange(n_sessions), n_full)
+    position_in_session = np.arange(n_full.sum()) - np.repeat(np.cumsum(n_full) - n_full, n_full)
 
-            # Apply full charging power for each full 15-minute timestep
-            for t in timesteplist_session[:int(required_timesteps)]:
-                resultdf.at[t, CS] += P_max
+    # Timestep position, charging station and charging power of all charged timesteps: first the full 15-minute timesteps,
+    # then the partial timestep remaining (e.g., 2.75 timesteps = 2 full + 1 partial) if this is still within the session.
+    # The partial timestep charges only the leftover energy at reduced power.
+    partial = (remaining_fraction > 0) & (i_start + n_required_full < i_end)
+    t_charged = np.concatenate([i_start[session_of_full] + position_in_session, i_start[partial] + n_required_full[partial]])
+    cs_charged = np.concatenate([cs_code[session_of_full], cs_code[partial]])
+    p_charged = np.concatenate([P_max[session_of_full], P_max[partial] * remaining_fraction[partial]])
 
-            # If there's a partial timestep remaining (e.g., 2.75 timesteps = 2 full + 1 partial)
-            remaining_fraction = required_timesteps - int(required_timesteps)
-            if remaining_fraction > 0:
-                # Apply reduced power for the partial timestep
-                # This charges only the leftover energy in the next available timestep
-                for t in timesteplist_session[int(required_timesteps):int(required_timesteps)+1]:
-                    resultdf.at[t, CS] += P_max * remaining_fraction
+    # Sum the charging power per timestep (rows) and charging station (columns) in a single bincount over the flattened array
+    n_timesteps = len(timesteps_index)
+    n_charging_stations = len(charging_stations)
+    charging_power = np.bincount(
+        t_charged * n_charging_stations + cs_charged, weights=p_charged, minlength=n_timesteps * n_charging_stations
+    ).reshape(n_timesteps, n_charging_stations)
 
+    # Create the result DataFrame with timesteps as index and one column per charging station
+    resultdf = pd.DataFrame(charging_power, index=timesteplist, columns=charging_stations)
 
-    return resultdf
\ No newline at end of file
+    return resultdf
@@ -5,17 +5,15 @@ Created on Fri Apr 25 16:49:21 2025
 Author: 4013425
 """
 
-import gurobipy as gp
 import pandas as pd
 import numpy as np
-import datetime
-import warnings
-warnings.filterwarnings('ignore')
 
 def volumetric_ToU(charging_session_data, timesteplist, CS, grid_tariff_df, DA_prices, dynamic_retail_prices_considered):
     """
     Optimizes the charging schedule for electric vehicles (EVs) using a **Volumetric Time-of-Use (ToU) pricing model**. 
     The goal is to minimize the charging cost considering grid tariffs and possibly dynamic retail prices.
+    As the sessions are independent and only limited by their charging demand and maximum charging power,
+    the optimal schedule of each session is found directly by charging at the cheapest timesteps first.
     
     Parameters
     ----------
@@ -52,83 +50,109 @@ def volumetric_ToU(charging_session_data, timesteplist, CS, grid_tariff_df, DA_p
 
     """
 
-    # Initialize an empty DataFrame with all values set to 0 to store the results
-    resultdf = pd.DataFrame(0, index=timesteplist, columns=[CS])
-
     # Convert timesteplist to a pandas DatetimeIndex to facilitate time-based slicing
     timesteps_index = pd.DatetimeIndex(timesteplist)
+
+    # Grid tariff (€/kWh) at each timestep, looked up once for all sessions
+    grid_tariff_at_t = grid_tariff_df['Grid tariff (€/kWh)'].reindex(timesteps_index).to_numpy(dtype=float)
+
+    # Day-ahead price (€/kWh) of the hour each timestep falls in, looked up once for all sessions
+    if dynamic_retail_prices_considered:
+        DA_price_at_t = DA_prices['Day-ahead price (€/MWh)'].reindex(
+            timesteps_index - pd.to_timedelta(timesteps_index.minute, unit='min')
+        ).to_numpy() / 1000
     
     # Time resolution (15 minutes = 0.25 hours)
     delta_t = 0.25
-    
-    # Large constant for scaling priority-related cost term
-    M = 1e9
+
+    # Total charging power at each timestep, initially set to 0
+    p_ch_tot = np.zeros(len(timesteps_index))
+
+    # Session details as NumPy arrays, indexed by the position of the session. The session windows are given by the
+    # position of the first timestep within and the first timestep after each session, found for all sessions at once.
+    first_t = timesteps_index.searchsorted(charging_session_data['Arrival time'], side='left')
+    last_t = timesteps_index.searchsorted(charging_session_data['Departure time'], side='left')
+    p_max_session = charging_session_data['Max. charging power (kW)'].to_numpy(dtype=float)
+    vol_session = charging_session_data['Charging demand (kWh)'].to_numpy(dtype=float)
+
+    # Sessions without charging demand or without any timestep in their session window do not charge, so these are
+    # skipped. The other sessions are handled in order of arrival, so that consecutive sessions use nearby price entries.
+    sessions_to_charge = np.flatnonzero((vol_session > 0) & (last_t > first_t))
+    sessions_to_charge = sessions_to_charge[np.argsort(first_t[sessions_to_charge], kind='stable')]
 
     # Loop through each charging session
-    for session in charging_session_data.index:
+    for session in sessions_to_charge:
         # Extract session details from the input data
-        arrival_time = charging_session_data.loc[session, 'Arrival time']
-        departure_time = charging_session_data.loc[session, 'Departure time']
-        p_max = charging_session_data.loc[session, 'Max. charging power (kW)']
-        vol = charging_session_data.loc[session, 'Charging demand (kWh)']
+        p_max = p_max_session[session]
+        vol = vol_session[session]
         
-        # Filter timesteps that fall within this session's arrival and departure times
-        timesteplist_session = timesteps_index[(timesteps_index >= arrival_time) & (timesteps_index < departure_time)]
+        # Timesteps that fall within this session's arrival and departure times
+        session_window = slice(first_t[session], last_t[session])
         
-        # Create a new optimization model using Gurobi
-        m = gp.Model()
-        m.Params.outputFlag = 0  # Suppresses all Gurobi output
+        # Cost per kWh at each timestep of the session: the grid tariff, plus the day-ahead price if dynamic retail prices are used
+        price = grid_tariff_at_t[session_window]
+        if dynamic_retail_prices_considered:
+            price = price + DA_price_at_t[session_window]
+
+        # The only constraints are the charging demand and the maximum charging power, so the cost-minimizing schedule
+        # charges at maximum power at the cheapest timesteps until the demand is met, with the remainder in the last one.
+        # The stable sort charges at the earliest timesteps among timesteps with the same price, like the priority term
+        # in the other models, which favors early charging if this leads to the same costs.
+        charging_order = np.argsort(price, kind='stable')
+        energy_charged = np.clip(vol - p_max * delta_t * np.arange(len(charging_order)), 0, p_max * delta_t)
+        p_ch = np.zeros(len(price))
+        p_ch[charging_order] = energy_charged / delta_t
+
+        # Add the optimal charging power of this session to the total charging power at the timesteps of the session
+        p_ch_tot[session_window] += np.round(p_ch, 1)
+
+    # Store the total charging power in a DataFrame indexed by the timesteps
+    resultdf = pd.DataFrame({CS: p_ch_tot}, index=timesteplist)
+    
+    return resultdf
 
-        m.Params.LogToConsole = 0  # Suppress Gurobi output to console
-        
-        # Define decision variables for charging power at each timestep
-        p_ch = m.addVars(timesteplist_session, lb=0, ub=p_max)
-        
-        # Define a variable for the total grid cost
-        C_grid = m.addVar()
-        
-        # New variable to prioritize charging at certain times (priority cost)
-        C_priority = m.addVar()
 
-        # Constraint: Total energy delivered (sum of power * time step) must equal the charging demand
-        m.addConstr(gp.quicksum(p_ch[t] * delta_t for t in timesteplist_session) == vol)
-        
-        # Constraint: Total cost of grid consumption
-        m.addConstr(C_grid == gp.quicksum(p_ch[t] * delta_t * grid_tariff_df.loc[t, 'Grid tariff (€/kWh)'] 
-                                           for t in timesteplist_session))
-        
-        # The goal is to prioritize charging earlier in the session if this leads to the same costs
-        # The priority term is based on the order of timesteps (earlier timesteps get higher weights)
-        m.addConstr(C_priority == gp.quicksum(p_ch[timesteplist_session[i]] * i for i in range(len(timesteplist_session))))
+def volumetric_ToU_all(charging_session_data, timesteplist, grid_tariff_df, DA_prices, dynamic_retail_prices_considered):
+    """
+    Optimizes the charging schedules of all charging stations under a **Volumetric Time-of-Use (ToU) pricing model**.
+    volumetric_ToU is run for each charging station, after splitting the sessions per charging station in a single pass.
 
-        # If dynamic retail prices are used, we add another cost term for the dynamic prices
-        if dynamic_retail_prices_considered:
-            C_DA = m.addVar(lb=-np.inf)  # Day-ahead price cost variable
-            m.addConstr(C_DA == gp.quicksum(p_ch[t] * delta_t * DA_prices.loc[t - datetime.timedelta(minutes=t.minute), 
-                                            'Day-ahead price (€/MWh)'] / 1000 for t in timesteplist_session))
-            # Objective function: Minimize both day-ahead price cost, grid consumption cost, and the priority cost. 
-            # By dividing C_priority by M, we ensure that the optimizer only prioritizes if this leads to the same grid costs and dynamic retail prices.
-            obj = C_DA + C_grid + C_priority / M
-        else:
-            # If no dynamic retail prices, minimize only grid cost and priority cost.
-            # By dividing C_priority by M, we ensure that the optimizer only prioritizes if this leads to the same grid costs and dynamic retail prices.
-            obj = C_grid + C_priority / M
-
-        # Set the objective function (to minimize the total cost)
-        m.setObjective(obj, gp.GRB.MINIMIZE)
-        
-        # Update and optimize the model
-        m.update()
-        m.optimize()
+    Parameters
+    ----------
+    charging_session_data : pd.DataFrame
+        DataFrame containing information about the charging sessions of all charging stations, with the columns expected
+        by volumetric_ToU and the 'Charging station ID' of each session.
 
-        # Create a temporary DataFrame to store the charging power for this session
-        resultdf_session = pd.DataFrame(0, index=resultdf.index, columns=['Charging power session'])
-        
-        # Store the optimal charging power for each timestep in the result dataframe
-        for t in timesteplist_session:
-            resultdf_session.at[t, 'Charging power session'] = round(p_ch[t].X, 1)
+    timesteplist : list
+        List of all considered timesteps in the optimization, typically each 15-minute interval.
+
+    grid_tariff_df : pd.DataFrame
+        DataFrame containing grid tariffs at each timestep in the form of €/kWh, see volumetric_ToU.
+
+    DA_prices : pd.DataFrame
+        DataFrame containing the day-ahead electricity prices in €/MWh for each timestep, see volumetric_ToU.
+
+    dynamic_retail_prices_considered : bool
+        Flag to specify whether to include dynamic retail prices in the objective function.
+
+    Returns
+    -------
+    resultdf : pd.DataFrame
+        DataFrame indexed by timesteps with one column per charging station, containing the charging power (kW) for each timestep.
+
+    """
+
+    # Split the sessions per charging station in a single pass with a groupby on the categorical charging station IDs,
+    # instead of comparing all IDs with each charging station. The charging stations keep their order of first appearance.
+    charging_station_ids = charging_session_data['Charging station ID']
+    sessions_per_CS = charging_session_data.groupby(
+        pd.Categorical(charging_station_ids, categories=charging_station_ids.unique()), observed=True
+    )
+
+    # Optimize each charging station and combine the results of all charging stations
+    resultdf = pd.DataFrame(index=timesteplist)
+    for CS, charging_session_data_CS in sessions_per_CS:
+        resultdf[CS] = volumetric_ToU(charging_session_data_CS, timesteplist, CS, grid_tariff_df, DA_prices,
+                                      dynamic_retail_prices_considered)[CS]
 
-        # Add the result from this session to the overall result DataFrame
-        resultdf[CS] += resultdf_session['Charging power session']
-    
     return resultdf